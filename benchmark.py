@@ -0,0 +1,89 @@
+"""
+Benchmarks against the testDB in config.py.
+
+    $ python benchmark.py
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import timeit
+from ormini.db import *
+from config import configs
+
+ROWS = 1000
+REPEAT = 20
+
+
+def _retained_size(result):
+    """Approximate bytes held by a result: the containers and every row object."""
+    if isinstance(result, list):
+        return sys.getsizeof(result) + sum(sys.getsizeof(r) for r in result)
+    return sys.getsizeof(result)
+
+
+def _setup():
+    update('drop table if exists bench')
+    update('create table bench (id int primary key, name varchar(20), rating int, age real)')
+    with TransactionContext():
+        for i in range(ROWS):
+            insert('bench', id=i, name='sailor%d' % i, rating=i % 10, age=20 + i % 50)
+
+
+@with_connection
+def bench_select():
+    print('%d rows, best of %d runs' % (ROWS, REPEAT))
+    cases = [
+        ('select', lambda: select('select id, rating from bench')),
+        ('select_tuples', lambda: select_tuples('select id, rating from bench')),
+        ('select_column', lambda: select_column('select rating from bench')),
+        ('select_one', lambda: select_one('select rating from bench where id=?', 7)),
+        ('select_scalar', lambda: select_scalar('select rating from bench where id=?', 7)),
+    ]
+    for name, func in cases:
+        seconds = min(timeit.repeat(func, number=1, repeat=REPEAT))
+        print('%-14s %8.3f ms %10d bytes' % (name, seconds * 1000, _retained_size(func())))
+
+
+def _worker_queries(seconds):
+    """Run point lookups on this process' own connection for the given time, return the count."""
+    n = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        select_scalar('select rating from bench where id=?', n % ROWS)
+        n += 1
+    return n
+
+
+@with_connection
+def bench_fork(workers=(1, 2, 4), seconds=2):
+    """Fork worker processes that inherit an open connection, and measure read throughput scaling."""
+    select_scalar('select count(*) from bench')
+    for count in workers:
+        children = []
+        for _ in range(count):
+            r, w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.write(w, str(_worker_queries(seconds)))
+                finally:
+                    os._exit(0)
+            os.close(w)
+            children.append((pid, r))
+        total = 0
+        for pid, r in children:
+            os.waitpid(pid, 0)
+            total += int(os.read(r, 32) or 0)
+            os.close(r)
+        print('%d workers %10.0f queries/s' % (count, total / float(seconds)))
+
+
+if __name__ == '__main__':
+    init_engine(**configs['testDB'])
+    _setup()
+    try:
+        bench_select()
+        bench_fork()
+    finally:
+        update('drop table if exists bench')
@@ -7,5 +7,19 @@ configs = {
         'user': 'root',
         'password': '',
         'database': 'test'
+    },
+    'shard0': {
+        'host': '127.0.0.1',
+        'port': 3306,
+        'user': 'root',
+        'password': '',
+        'database': 'test_shard0'
+    },
+    'shard1': {
+        'host': '127.0.0.1',
+        'port': 3306,
+        'user': 'root',
+        'password': '',
+        'database': 'test_shard1'
     }
 }
\ No newline at end of file
@@ -1,11 +1,21 @@
+import atexit
+import ctypes
+import heapq
+import os
+import re
 import threading
 import logging
+import time
+import weakref
 from utils import Dict
 import mysql.connector
 
 # global connector function:
 connector = None
 
+# global statement hooks, each called as hook(sql, args) before a statement runs:
+statement_hooks = []
+
 
 class DateBaseError(Exception):
     pass
@@ -15,33 +25,92 @@ class MultiColumnsError(DateBaseError):
     pass
 
 
+class QueryTimeoutError(DateBaseError):
+    pass
+
+
+# errors of statements interrupted by KILL QUERY or by MAX_EXECUTION_TIME
+_TIMEOUT_ERRORS = (1317, 3024)
+
+
+def _release_inherited(connection):
+    """Let go of a connection inherited from the parent process without ending the parent's session"""
+    sock = getattr(getattr(connection, '_socket', None), 'sock', None)
+    if sock is not None:
+        # close the child's descriptor only, the shutdown() done when the driver socket is freed then fails
+        sock.close()
+    else:
+        # the C extension sends QUIT when freed and does not expose its descriptor, so it is never freed
+        ctypes.pythonapi.Py_IncRef(ctypes.py_object(connection))
+
+
+# every live lazy connection, of any thread:
+_connections = weakref.WeakSet()
+
+
 class _LazyConnection(object):
     """
     Database connection object.
 
-    Lazy Connect the Database when function cursor is called.
+    Lazy Connect the Database when function cursor is called. A connection inherited across os.fork() is
+    discarded in the child, which then opens its own.
     """
 
-    def __init__(self):
+    def __init__(self, connector=None, **options):
+        # connector of the engine to use, the global connector if None
+        self._connector = connector
+        # connection parameters overriding those of the engine
+        self._options = options
         self._connection = None
-
-    def cursor(self):
+        self._pid = os.getpid()
+        _connections.add(self)
+
+    def check_fork(self):
+        """Drop the connection if it was opened by the parent process"""
+        pid = os.getpid()
+        if self._pid != pid:
+            if self._connection is not None:
+                logging.info('discard connection <%s> inherited from process %d...' % (
+                    hex(id(self._connection)), self._pid))
+                _release_inherited(self._connection)
+                self._connection = None
+            self._pid = pid
+
+    def cursor(self, **kw):
         """Return cursor"""
         global connector
+        self.check_fork()
         if self._connection is None:
-            if connector is None:
+            connect = self._connector or connector
+            if connect is None:
                 raise DateBaseError('Connector is not initialized.')
-            self._connection = connector()
+            self._connection = connect(**self._options)
             logging.info('open connection <%s>...' % hex(id(self._connection)))
-        return self._connection.cursor()
+        return self._connection.cursor(**kw)
+
+    def kill_query(self):
+        """Kill the statement running on the connection, from a new connection"""
+        connect = self._connector or connector
+        killer = connect()
+        try:
+            cursor = killer.cursor()
+            cursor.execute('KILL QUERY %d' % self._connection.connection_id)
+            cursor.close()
+        finally:
+            killer.close()
 
     def commit(self):
-        self._connection.commit()
+        self.check_fork()
+        if self._connection:
+            self._connection.commit()
 
     def rollback(self):
-        self._connection.rollback()
+        self.check_fork()
+        if self._connection:
+            self._connection.rollback()
 
     def cleanup(self):
+        self.check_fork()
         if self._connection:
             connection = self._connection
             self._connection = None
@@ -55,10 +124,15 @@ class _DbContext(threading.local):
     def __init__(self):
         self.connection = None
         self.transactions = 0
+        self.commit_window = None
+        # connector of the engine used by this thread, the global connector if None
+        self.connector = None
+        # time by which statements must finish, None for no deadline
+        self.deadline = None
 
-    def init(self):
+    def init(self, **options):
         """
-        init the connection.
+        init the connection, options override connection parameters of the engine.
 
         :return is new connection created
         :rtype bool
@@ -66,14 +140,24 @@ class _DbContext(threading.local):
         is_init = self.connection is not None
         if not is_init:
             logging.info('open lazy connection...')
-            self.connection = _LazyConnection()
+            self.connection = _LazyConnection(self.connector, **options)
             self.transactions = 0
+            self.commit_window = None
         return not is_init
 
     def cleanup(self):
         self.connection.cleanup()
         self.connection = None
 
+    def set_deadline(self, timeout):
+        """Tighten the deadline to timeout seconds from now, return the previous deadline"""
+        previous = self.deadline
+        if timeout is not None:
+            deadline = time.time() + timeout
+            if previous is None or deadline < previous:
+                self.deadline = deadline
+        return previous
+
     def cursor(self):
         return self.connection.cursor()
 
@@ -82,16 +166,34 @@ class _DbContext(threading.local):
 db_context = _DbContext()
 
 
-def init_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
-    global connector
-    if connector is not None:
-        raise DateBaseError('Connector is already initialized.')
+def _release_inherited_connections():
+    """Release the connections of every thread inherited from the parent process"""
+    for connection in list(_connections):
+        connection.check_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_release_inherited_connections)
+# without fork hooks, as on Python 2, a child that exits before using its connections releases them at exit,
+# before interpreter shutdown frees them
+atexit.register(_release_inherited_connections)
+
+
+def create_connector(user, password, database, host='127.0.0.1', port=3306, **kw):
+    """Create a function that opens a new connection to the database, keyword arguments override parameters"""
     params = dict(user=user, password=password, database=database, host=host, port=port)
     defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=False, buffered=True)
     for k, v in defaults.items():
         params[k] = kw.pop(k, v)
     params.update(kw)
-    connector = lambda: mysql.connector.connect(**params)
+    return lambda **options: mysql.connector.connect(**dict(params, **options))
+
+
+def init_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
+    global connector
+    if connector is not None:
+        raise DateBaseError('Connector is already initialized.')
+    connector = create_connector(user, password, database, host, port, **kw)
     logging.info('Init mysql engine <%s> ok.' % hex(id(connector)))
 
 
@@ -100,6 +202,38 @@ def close_engine():
     connector = None
 
 
+class EngineContext(object):
+    """
+    Context object that runs the statements of the current thread on another engine, given by its connector. The
+    connection state of the thread is put aside and restored on exit.
+    with EngineContext(create_connector(**configs['otherDB'])):
+        select('select * from sailor')
+    """
+
+    def __init__(self, connector):
+        self.connector = connector
+
+    def __enter__(self):
+        global db_context
+        self.switched = db_context.connector is not self.connector
+        if self.switched:
+            self.saved = (db_context.connection, db_context.transactions, db_context.commit_window,
+                          db_context.connector)
+            db_context.connection, db_context.transactions, db_context.commit_window = None, 0, None
+            db_context.connector = self.connector
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        global db_context
+        if self.switched:
+            try:
+                if db_context.connection:
+                    db_context.cleanup()
+            finally:
+                (db_context.connection, db_context.transactions, db_context.commit_window,
+                 db_context.connector) = self.saved
+
+
 class _ConnectionContext(object):
     """
     Connection Context object that can open and close connection context. The object can be nested and only the most
@@ -108,41 +242,135 @@ class _ConnectionContext(object):
         pass
         with connection():
             pass
+    Statements in the context must finish within timeout seconds, if given. Other keyword arguments override
+    connection parameters of the engine, if the context opens the connection.
     """
 
+    def __init__(self, timeout=None, **options):
+        self.timeout = timeout
+        self.options = options
+
     def __enter__(self):
         global db_context
-        self.should_cleanup = db_context.init()
+        self.should_cleanup = db_context.init(**self.options)
+        self.previous_deadline = db_context.set_deadline(self.timeout)
         return self
 
     def __exit__(self, exctype, excvalue, traceback):
         global db_context
+        db_context.deadline = self.previous_deadline
         if self.should_cleanup:
             db_context.cleanup()
 
 
-def with_connection(func):
-    """Decorator for reuse connection."""
+def with_connection(func=None, timeout=None):
+    """Decorator for reuse connection, @with_connection(timeout=5) also sets a deadline for its statements."""
+    if func is None:
+        return lambda f: with_connection(f, timeout)
 
     def wrapper(*args, **kw):
-        with _ConnectionContext():
+        with _ConnectionContext(timeout):
             return func(*args, **kw)
 
     return wrapper
 
 
+class CommitWindowContext(object):
+    """
+    Connection context that coalesces autocommit writes made outside transactions. They are committed together
+    once max_statements writes are pending, once max_delay milliseconds have passed since the first pending write,
+    and when the context exits. Only the most outer window has effect.
+
+    The delay is checked when the next statement of the context runs, there is no timer: code that stops running
+    statements keeps pending writes and their row locks uncommitted, beyond max_delay, until the context exits.
+    with CommitWindowContext(max_statements=100, max_delay=50):
+        for d in data:
+            insert('sailor', **d)
+    """
+
+    def __init__(self, max_statements=100, max_delay=50):
+        self.max_statements = max_statements
+        self.max_delay = max_delay
+        self.pending = 0
+        self.since = None
+
+    def __enter__(self):
+        global db_context
+        self.should_cleanup = db_context.init()
+        self.is_outer = db_context.commit_window is None
+        if self.is_outer:
+            db_context.commit_window = self
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        global db_context
+        try:
+            if self.is_outer:
+                db_context.commit_window = None
+                # statements outside transactions are committed even if an error occurred
+                self.flush()
+        finally:
+            if self.should_cleanup:
+                db_context.cleanup()
+
+    def record(self):
+        """Record an autocommit write, commit if the window is full."""
+        self.pending += 1
+        if self.since is None:
+            self.since = time.time()
+        if self.pending >= self.max_statements:
+            self.flush()
+        else:
+            self.expire()
+
+    def expire(self):
+        """Commit pending writes if the first of them has waited max_delay milliseconds."""
+        if self.since is not None and (time.time() - self.since) * 1000 >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        """Commit pending writes."""
+        global db_context
+        if self.pending:
+            logging.info('group commit of %d statements' % self.pending)
+            db_context.connection.commit()
+        self.pending = 0
+        self.since = None
+
+
+def with_commit_window(max_statements=100, max_delay=50):
+    """Decorator that runs function in a commit window."""
+
+    def decorator(func):
+        def wrapper(*args, **kw):
+            with CommitWindowContext(max_statements, max_delay):
+                return func(*args, **kw)
+
+        return wrapper
+
+    return decorator
+
+
 class TransactionContext(object):
-    """Transaction context object which handle the transactions"""
+    """Transaction context object which handle the transactions, statements must finish within timeout seconds"""
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
 
     def __enter__(self):
         global db_context
         self.should_close_connection = db_context.init()
+        self.previous_deadline = db_context.set_deadline(self.timeout)
+        # a rollback must not discard autocommit writes pending in a commit window
+        if db_context.transactions == 0 and db_context.commit_window:
+            db_context.commit_window.flush()
         db_context.transactions += 1
         logging.info('begin transaction...' if db_context.transactions == 1 else 'join current transaction...')
         return self
 
     def __exit__(self, exctype, excvalue, traceback):
         global db_context
+        db_context.deadline = self.previous_deadline
         db_context.transactions -= 1
         try:
             if db_context.transactions == 0:
@@ -173,75 +401,299 @@ class TransactionContext(object):
         logging.info('rollback ok.')
 
 
-def with_transaction(func):
-    """A decorator that makes function around transaction."""
+def with_transaction(func=None, timeout=None):
+    """A decorator that makes function around transaction, @with_transaction(timeout=5) also sets a deadline."""
+    if func is None:
+        return lambda f: with_transaction(f, timeout)
 
     def wrapper(*args, **kw):
-        with TransactionContext():
+        with TransactionContext(timeout):
             return func(*args, **kw)
 
     return wrapper
 
 
-def base_select(sql, single, *args):
-    """execute select SQL and fetch results."""
+def add_statement_hook(hook):
+    """Register hook(sql, args) to be called before every select or update statement."""
+    if hook not in statement_hooks:
+        statement_hooks.append(hook)
+
+
+def remove_statement_hook(hook):
+    if hook in statement_hooks:
+        statement_hooks.remove(hook)
+
+
+def _run_statement_hooks(sql, args):
+    for hook in list(statement_hooks):
+        hook(sql, args)
+
+
+_select_re = re.compile(r'^\s*select\b', re.IGNORECASE)
+
+
+class _Watch(object):
+    """A statement watched by the watchdog, killed if it still runs at expiry."""
+
+    def __init__(self, connection, expiry):
+        self.connection = connection
+        self.expiry = expiry
+        self.fired = False
+        self.done = False
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        # waits for a kill in progress, so it can not hit the next statement
+        with self.lock:
+            self.done = True
+
+    def kill(self):
+        with self.lock:
+            if self.done:
+                return
+            self.fired = True
+            logging.warning('kill statement after timeout...')
+            try:
+                self.connection.kill_query()
+            except Exception as e:
+                logging.warning('kill failed: %s' % e)
+
+
+class _Watchdog(object):
+    """One daemon thread that kills the watched statements of every thread still running after their timeout."""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.condition = threading.Condition()
+        # heap of (expiry, sequence number, watch)
+        self.watches = []
+        self.count = 0
+        self.thread = None
+        self.stopped = False
+
+    def watch(self, connection, timeout):
+        if self.pid != os.getpid():
+            # the thread and the state of the lock were left in the parent process
+            self.__init__()
+        watch = _Watch(connection, time.time() + timeout)
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='ormini-watchdog')
+                self.thread.daemon = True
+                self.thread.start()
+            self.count += 1
+            heapq.heappush(self.watches, (watch.expiry, self.count, watch))
+            self.condition.notify()
+        return watch
+
+    def stop(self):
+        """Stop the thread, before interpreter shutdown tears down what it uses"""
+        if self.pid != os.getpid():
+            # the thread and the state of the lock were left in the parent process
+            return
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.stopped:
+                    return
+                # finished statements are dropped once they reach the top of the heap
+                while self.watches and self.watches[0][2].done:
+                    heapq.heappop(self.watches)
+                if not self.watches:
+                    self.condition.wait()
+                    continue
+                left = self.watches[0][0] - time.time()
+                if left > 0:
+                    self.condition.wait(left)
+                    continue
+                watch = heapq.heappop(self.watches)[2]
+            watch.kill()
+
+
+_watchdog = _Watchdog()
+atexit.register(_watchdog.stop)
+
+
+def _expire_commit_window():
+    """Commit the writes of the commit window of the context if they have waited long enough"""
+    global db_context
+    if db_context.transactions == 0 and db_context.commit_window:
+        db_context.commit_window.expire()
+
+
+def _statement_timeout(timeout):
+    """Get the timeout of the next statement from its own timeout and the deadline of the context"""
+    global db_context
+    if db_context.deadline is not None:
+        left = db_context.deadline - time.time()
+        if left <= 0:
+            raise QueryTimeoutError('Deadline exceeded.')
+        if timeout is None or left < timeout:
+            timeout = left
+    return timeout
+
+
+def _execute(cursor, sql, args, timeout, **kw):
+    """Execute SQL on cursor, kill it and raise QueryTimeoutError if it runs longer than timeout seconds"""
+    global db_context
+    if timeout is None:
+        cursor.execute(sql, args, **kw)
+        return
+    # reads are stopped by the server as well
+    hint = lambda m: '%s /*+ MAX_EXECUTION_TIME(%d) */' % (m.group(0), max(1, int(timeout * 1000)))
+    sql = _select_re.sub(hint, sql, 1)
+    watch = _watchdog.watch(db_context.connection, timeout)
+    try:
+        with watch:
+            cursor.execute(sql, args, **kw)
+    except mysql.connector.Error as e:
+        if watch.fired or e.errno in _TIMEOUT_ERRORS:
+            raise QueryTimeoutError('Statement exceeded %.3f seconds: %s' % (timeout, e))
+        raise
+    # some interrupted statements return without error, their results can not be trusted
+    if watch.fired:
+        raise QueryTimeoutError('Statement exceeded %.3f seconds.' % timeout)
+
+
+def base_fetch(sql, single, *args, **kw):
+    """execute select SQL and fetch raw rows from the driver, return column names and rows."""
     global db_context
     cursor = None
     sql = sql.replace('?', '%s')
     logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    _run_statement_hooks(sql, args)
+    timeout = _statement_timeout(kw.pop('timeout', None))
+    _expire_commit_window()
     try:
         cursor = db_context.connection.cursor()
-        cursor.execute(sql, args)
+        _execute(cursor, sql, args, timeout)
         if cursor.description:
             names = [x[0] for x in cursor.description]
         else:
             raise DateBaseError("No cursor description.")
         if single:
-            values = cursor.fetchone()
-            if not values:
-                return None
-            return Dict(names, values)
-        return [Dict(names, x) for x in cursor.fetchall()]
+            return names, cursor.fetchone()
+        return names, cursor.fetchall()
     finally:
         if cursor:
             cursor.close()
 
 
+def base_select(sql, single, *args, **kw):
+    """execute select SQL and fetch results."""
+    names, values = base_fetch(sql, single, *args, **kw)
+    if single:
+        if not values:
+            return None
+        return Dict(names, values)
+    return [Dict(names, x) for x in values]
+
+
 @with_connection
-def select_one(sql, *args):
+def select_one(sql, *args, **kw):
     """Execute insert SQL and fetch the first result"""
-    return base_select(sql, True, *args)
+    return base_select(sql, True, *args, **kw)
 
 
 @with_connection
-def select_int(sql, *args):
+def select_int(sql, *args, **kw):
     """Execute insert SQL with integer result"""
-    d = base_select(sql, True, *args)
-    if len(d) != 1:
+    return select_scalar(sql, *args, **kw)
+
+
+@with_connection
+def select(sql, *args, **kw):
+    """Execute select SQL, timeout=seconds kills it if it runs longer"""
+    return base_select(sql, False, *args, **kw)
+
+
+@with_connection
+def select_tuples(sql, *args, **kw):
+    """Execute select SQL, return rows as tuples without building a Dict per row"""
+    return base_fetch(sql, False, *args, **kw)[1]
+
+
+@with_connection
+def select_column(sql, *args, **kw):
+    """Execute select SQL of one column, return a flat list of its values"""
+    names, rows = base_fetch(sql, False, *args, **kw)
+    if len(names) != 1:
         raise MultiColumnsError('Expect only one column.')
-    return d.values()[0]
+    return [r[0] for r in rows]
 
 
 @with_connection
-def select(sql, *args):
-    """Execute select SQL"""
-    return base_select(sql, False, *args)
+def select_scalar(sql, *args, **kw):
+    """Execute select SQL of one column, return the value of the first row or None"""
+    names, row = base_fetch(sql, True, *args, **kw)
+    if len(names) != 1:
+        raise MultiColumnsError('Expect only one column.')
+    return row[0] if row else None
+
+
+def iter_tuples(sql, *args, **kw):
+    """
+    Execute select SQL on an unbuffered cursor and yield rows as tuples, fetching chunk_size rows at a time.
+    timeout bounds the execution of the statement only. No other statement may run on the connection until the
+    generator is exhausted or closed.
+    """
+    global db_context
+    chunk_size = kw.pop('chunk_size', 1000)
+    with _ConnectionContext():
+        cursor = None
+        sql = sql.replace('?', '%s')
+        logging.info('SQL: %s, ARGS: %s' % (sql, args))
+        _run_statement_hooks(sql, args)
+        timeout = _statement_timeout(kw.pop('timeout', None))
+        _expire_commit_window()
+        exhausted = True
+        try:
+            cursor = db_context.connection.cursor(buffered=False)
+            _execute(cursor, sql, args, timeout)
+            exhausted = False
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    exhausted = True
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            if cursor:
+                # the connection can not be reused until the whole result is read
+                while not exhausted and cursor.fetchmany(chunk_size):
+                    pass
+                cursor.close()
 
 
 @with_connection
-def base_update(sql, *args):
+def base_update(sql, *args, **kw):
     global db_context
     cursor = None
     sql = sql.replace('?', '%s')
     logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    _run_statement_hooks(sql, args)
+    timeout = _statement_timeout(kw.pop('timeout', None))
     try:
         cursor = db_context.connection.cursor()
-        cursor.execute(sql, args)
+        _execute(cursor, sql, args, timeout)
         r = cursor.rowcount
         # No transaction:
         if db_context.transactions == 0:
-            logging.info('auto commit')
-            db_context.connection.commit()
+            if db_context.commit_window:
+                db_context.commit_window.record()
+            else:
+                logging.info('auto commit')
+                db_context.connection.commit()
         return r
     finally:
         if cursor:
@@ -249,19 +701,23 @@ def base_update(sql, *args):
 
 
 @with_connection
-def multi_base_update(sql, *args):
+def multi_base_update(sql, *args, **kw):
     global db_context
     cursor = None
     sql = sql.replace('?', '%s')
     logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    timeout = _statement_timeout(kw.pop('timeout', None))
     try:
         cursor = db_context.connection.cursor()
-        cursor.execute(sql, args, multi=True)
+        _execute(cursor, sql, args, timeout, multi=True)
         r = cursor.rowcount
         # No transaction:
         if db_context.transactions == 0:
-            logging.info('auto commit')
-            db_context.connection.commit()
+            if db_context.commit_window:
+                db_context.commit_window.record()
+            else:
+                logging.info('auto commit')
+                db_context.connection.commit()
         return r
     finally:
         if cursor:
@@ -276,12 +732,20 @@ def insert(table, **kw):
     return base_update(sql, *args)
 
 
-def update(sql, *args):
-    """Execute update SQL"""
-    return base_update(sql, *args)
+def insert_many(table, cols, rows):
+    """Execute one multi-row insert SQL for rows of values in the order of cols"""
+    values = '(%s)' % ','.join(['?' for _ in range(len(cols))])
+    sql = 'insert into `%s` (%s) values %s' % (
+        table, ','.join(['`%s`' % col for col in cols]), ','.join([values for _ in range(len(rows))]))
+    return base_update(sql, *[v for row in rows for v in row])
+
+
+def update(sql, *args, **kw):
+    """Execute update SQL, timeout=seconds kills it if it runs longer"""
+    return base_update(sql, *args, **kw)
 
 
 # TODO  fix bug
-def multi_update(sql, *args):
+def multi_update(sql, *args, **kw):
     """Execute multi update SQL"""
-    return multi_base_update(sql, *args)
+    return multi_base_update(sql, *args, **kw)
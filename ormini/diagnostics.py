@@ -0,0 +1,234 @@
+import logging
+import os
+import re
+import threading
+import traceback
+import warnings
+import db
+from utils import Dict, normalize_sql
+
+_explainable_re = re.compile(r'^\s*(select|update|delete)\b', re.IGNORECASE)
+_table_re = re.compile(r'\b(?:from|update|join)\s+`?(\w+)`?', re.IGNORECASE)
+_where_re = re.compile(r'\bwhere\b(.*?)(?:\border\s+by\b|\bgroup\s+by\b|\blimit\b|$)', re.IGNORECASE | re.DOTALL)
+_order_re = re.compile(r'\border\s+by\b(.*?)(?:\blimit\b|$)', re.IGNORECASE | re.DOTALL)
+_group_re = re.compile(r'\bgroup\s+by\b(.*?)(?:\bhaving\b|\border\s+by\b|\blimit\b|$)', re.IGNORECASE | re.DOTALL)
+_condition_re = re.compile(r'`?(\w+)`?\s*(?:<=>|!=|<>|<=|>=|=|<|>|\blike\b|\bin\b|\bbetween\b|\bis\b)',
+                           re.IGNORECASE)
+_column_re = re.compile(r'`?(\w+)`?(?:\s+(?:asc|desc))?\s*(?:,|$)', re.IGNORECASE)
+
+
+def _columns(regex, sql, column_regex):
+    match = regex.search(sql)
+    if not match:
+        return []
+    columns = []
+    for column in column_regex.findall(match.group(1).strip()):
+        if column.lower() not in ('and', 'or', 'not') and column not in columns:
+            columns.append(column)
+    return columns
+
+
+def _index_columns(model):
+    """Column lists of every index on the model's table."""
+    indexes = [[f.name] for f in model.__fields__.values() if f.primary_key or f.db_index or f.unique]
+    for index in model.__indexes__:
+        indexes.append([model.__fields__[f].name for f in index.fields])
+    return indexes
+
+
+def _is_indexed(model, columns):
+    """Whether some index on the model starts with exactly these columns, in any order."""
+    return any(set(index[:len(columns)]) == set(columns) for index in _index_columns(model))
+
+
+def _attribute_name(model, column):
+    for k, f in model.__fields__.items():
+        if f.name == column:
+            return k
+    return None
+
+
+class QueryInspector(object):
+    """
+    Diagnostic mode that runs EXPLAIN once for every distinct statement shape executed through base_select and
+    base_update by the thread that opened it, and records full scans, filesorts and temporary tables.
+
+    with QueryInspector() as inspector:
+        Sailor.get(sname='dustin')
+    print inspector.report(Sailor, Reserve)
+    """
+
+    def __init__(self):
+        # statement shape -> list of EXPLAIN rows
+        self.plans = dict()
+        self.problems = []
+        self.thread = None
+
+    def __enter__(self):
+        # hooks see the statements of every thread, only those of this one are inspected
+        self.thread = threading.current_thread()
+        db.add_statement_hook(self)
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        db.remove_statement_hook(self)
+
+    def __call__(self, sql, args):
+        if threading.current_thread() is not self.thread or not _explainable_re.match(sql):
+            return
+        shape = normalize_sql(sql)
+        if shape in self.plans:
+            return
+        self.plans[shape] = []
+        cursor = None
+        try:
+            cursor = db.db_context.connection.cursor()
+            cursor.execute('explain ' + sql, args)
+            names = [x[0] for x in cursor.description]
+            plan = [Dict(names, x) for x in cursor.fetchall()]
+        except Exception as e:
+            logging.warning('EXPLAIN failed for <%s>: %s' % (shape, e))
+            return
+        finally:
+            if cursor:
+                cursor.close()
+        self.plans[shape] = plan
+        for row in plan:
+            self._check(shape, sql, row)
+
+    def _check(self, shape, sql, row):
+        extra = row.get('Extra') or ''
+        kinds = []
+        if row.get('type') == 'ALL':
+            kinds.append('full scan')
+        elif row.get('type') == 'index':
+            kinds.append('full index scan')
+        if 'Using filesort' in extra:
+            kinds.append('filesort')
+        if 'Using temporary' in extra:
+            kinds.append('temporary table')
+        tables = _table_re.findall(sql)
+        for kind in kinds:
+            logging.warning('%s on %s: %s' % (kind, row.get('table'), shape))
+            self.problems.append(Dict(
+                kind=kind, shape=shape, table=row.get('table') or (tables[0] if tables else None),
+                rows=row.get('rows'), key=row.get('key'),
+                where=_columns(_where_re, sql, _condition_re),
+                order_by=_columns(_order_re, sql, _column_re),
+                group_by=_columns(_group_re, sql, _column_re)))
+
+    def suggestions(self, *models):
+        """Map recorded problems back to model fields and suggest indexes to add."""
+        tables = dict((m.__table_name__, m) for m in models)
+        result = []
+        for problem in self.problems:
+            model = tables.get(problem.table)
+            if model is None:
+                continue
+            if problem.kind == 'filesort':
+                wanted = problem.where + [c for c in problem.order_by if c not in problem.where]
+            elif problem.kind == 'temporary table':
+                wanted = problem.group_by
+            else:
+                wanted = problem.where
+            columns = [c for c in wanted if _attribute_name(model, c) is not None]
+            if not columns:
+                continue
+            if _is_indexed(model, columns):
+                continue
+            if len(columns) == 1:
+                suggestion = 'set db_index=True on %s.%s' % (model.__name__, _attribute_name(model, columns[0]))
+            else:
+                suggestion = 'add Index([%s]) to %s.Meta.indexes' % (
+                    ', '.join("'%s'" % _attribute_name(model, c) for c in columns), model.__name__)
+            if suggestion not in [s.suggestion for s in result]:
+                s = Dict(**problem)
+                s.update(model=model.__name__, columns=columns, suggestion=suggestion)
+                result.append(s)
+        return result
+
+    def report(self, *models):
+        """Human readable report of recorded problems and index suggestions."""
+        lines = ['%d statement shapes explained, %d problems found.' % (len(self.plans), len(self.problems))]
+        for problem in self.problems:
+            lines.append('[%s] %s (table %s, ~%s rows)' % (problem.kind, problem.shape, problem.table, problem.rows))
+        for s in self.suggestions(*models):
+            lines.append('suggestion: %s  <- %s' % (s.suggestion, s.shape))
+        return '\n'.join(lines)
+
+
+class NPlusOneError(db.DateBaseError):
+    pass
+
+
+class NPlusOneWarning(UserWarning):
+    pass
+
+
+def _caller_stack():
+    """Formatted stack of the caller, without frames from inside ormini."""
+    package = os.path.dirname(os.path.abspath(__file__))
+    frames = [f for f in traceback.extract_stack() if not os.path.abspath(f[0]).startswith(package)]
+    return ''.join(traceback.format_list(frames))
+
+
+class NPlusOneDetector(object):
+    """
+    Warn, or raise NPlusOneError, when the same statement shape runs more than threshold times in one scope.
+
+    The scope is the with block of the detector, in the thread that installed it. With per_connection=True it is
+    every outermost connection context instead, so each with_connection or with_transaction block is counted on
+    its own:
+
+    with NPlusOneDetector(threshold=5):
+        for sid in sids:
+            Sailor.get_by_pk(sid)
+    """
+
+    def __init__(self, threshold=10, raise_error=False, per_connection=False):
+        self.threshold = threshold
+        self.raise_error = raise_error
+        self.per_connection = per_connection
+        self.reports = []
+        self._local = threading.local()
+        self.thread = None
+
+    def __enter__(self):
+        self._local = threading.local()
+        self.install()
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        self.uninstall()
+
+    def install(self):
+        # hooks see the statements of every thread, only those of this one are counted
+        self.thread = threading.current_thread()
+        db.add_statement_hook(self)
+
+    def uninstall(self):
+        db.remove_statement_hook(self)
+
+    def _counts(self):
+        local = self._local
+        connection = db.db_context.connection
+        if not hasattr(local, 'counts') or (self.per_connection and local.connection is not connection):
+            local.counts = dict()
+            local.connection = connection
+        return local.counts
+
+    def __call__(self, sql, args):
+        if threading.current_thread() is not self.thread:
+            return
+        counts = self._counts()
+        shape = normalize_sql(sql)
+        counts[shape] = counts.get(shape, 0) + 1
+        if counts[shape] != self.threshold + 1:
+            return
+        stack = _caller_stack()
+        self.reports.append(Dict(shape=shape, threshold=self.threshold, stack=stack))
+        message = 'possible N+1 queries, <%s> ran more than %d times in one scope:\n%s' % (
+            shape, self.threshold, stack)
+        if self.raise_error:
+            raise NPlusOneError(message)
+        warnings.warn(message, NPlusOneWarning)
@@ -8,6 +8,24 @@ def check(value):
     return 'CHECK (%s)' % value
 
 
+class Index(object):
+    """
+    Index over one or more fields, declared in the inner Meta class of a model.
+
+    class Meta:
+        indexes = [Index(['sname', 'age']), Index('email', unique=True, lengths={'email': 50})]
+    """
+
+    def __init__(self, fields, name=None, unique=False, lengths=None):
+        if isinstance(fields, basestring):
+            fields = [fields]
+        self.fields = list(fields)
+        self.name = name
+        self.unique = unique
+        # prefix length of each indexed field, required for text fields
+        self.lengths = dict(lengths or {})
+
+
 class Field(object):
     # Relation Flags
     many_to_many = None
@@ -78,6 +96,19 @@ class TextField(Field):
         super(TextField, self).__init__(**kwargs)
 
 
+class TimestampField(Field):
+    def __init__(self, auto_now=False, **kwargs):
+        # auto_now columns are set by the database on insert and on every change of the row
+        self.auto_now = auto_now
+        kwargs['data_type'] = 'timestamp(6)'
+        if auto_now:
+            kwargs['not_null'] = True
+            kwargs['editable'] = False
+        if 'default' not in kwargs:
+            kwargs['default'] = None
+        super(TimestampField, self).__init__(**kwargs)
+
+
 class AutoPrimaryKeyField(Field):
     def __init__(self, **kwargs):
         kwargs['primary_key'] = True
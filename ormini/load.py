@@ -1,9 +1,268 @@
+import csv
+import datetime
+import decimal
+import gzip
+import itertools
 import json
-from ormini.db import insert
+import logging
+import os
+import tempfile
+import mysql.connector
+from ormini.db import update, insert_many, select, select_tuples, select_column, iter_tuples, with_connection, \
+    TransactionContext, _ConnectionContext, db_context
+from ormini.utils import Dict
 
+# file formats understood by load_data and dump_data
+FORMATS = ('json', 'jsonl', 'csv', 'tsv')
 
-def load_data(model, file_path):
-    with open(file_path) as data_file:
-        data = json.load(data_file)
-    for d in data:
-        insert(model, **d)
+# how NULL is written in CSV and TSV files, as MySQL does
+NULL = '\\N'
+
+# errors raised when the server or the client does not allow LOAD DATA LOCAL INFILE
+LOCAL_INFILE_ERRORS = (1148, 2068, 3948, 3950)
+# errno of the refusal of the pure Python client, raised without an error number of its own
+CLIENT_REFUSED = -1
+
+
+def _format(file_path, format):
+    if format is None:
+        name = file_path[:-3] if file_path.endswith('.gz') else file_path
+        format = name.rsplit('.', 1)[-1].lower()
+    if format not in FORMATS:
+        raise ValueError('unsupported format %s' % format)
+    return format
+
+
+def _open(file_path, mode, compress=None):
+    if compress or (compress is None and file_path.endswith('.gz')):
+        return gzip.open(file_path, mode)
+    return open(file_path, mode)
+
+
+def _table(model):
+    """Table name of a model class or of a table name"""
+    return getattr(model, '__table_name__', model)
+
+
+def _columns(model):
+    """Column names and single primary key column (or None) of a model class or of a table name"""
+    if hasattr(model, '__fields__'):
+        return [f.name for f in model.__fields__.values()], model.__primary_key__.name
+    columns = select_column('select column_name from information_schema.columns '
+                            'where table_schema=database() and table_name=? order by ordinal_position', model)
+    pk = select_column('select column_name from information_schema.key_column_usage '
+                       'where table_schema=database() and table_name=? and constraint_name=?', model, 'PRIMARY')
+    return columns, pk[0] if len(pk) == 1 else None
+
+
+def _rows(table, columns, pk, chunk_size):
+    """Stream rows as tuples, by keyset pagination on the primary key or else on an unbuffered cursor"""
+    sql = 'select %s from %s' % (','.join(['`%s`' % c for c in columns]), table)
+    if pk is None:
+        for row in iter_tuples(sql, chunk_size=chunk_size):
+            yield row
+        return
+    index = columns.index(pk)
+    rows = select_tuples('%s order by `%s` limit ?' % (sql, pk), chunk_size)
+    while rows:
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            break
+        rows = select_tuples('%s where `%s`>? order by `%s` limit ?' % (sql, pk, pk), rows[-1][index], chunk_size)
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (decimal.Decimal, datetime.timedelta)):
+        return str(value)
+    if isinstance(value, bytearray):
+        return value.decode('utf-8')
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def _csv_value(value):
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, bytearray):
+        return str(value)
+    return value
+
+
+def dump_data(model, file_path, format=None, chunk_size=1000, compress=None):
+    """
+    Stream all rows of a model or table into a json, jsonl, csv or tsv file with constant memory, return the number
+    of rows written. The format is taken from the file extension if not given; files ending with .gz or dumped
+    with compress=True are gzip compressed. The rows are read in one transaction, as a consistent snapshot.
+    """
+    format = _format(file_path, format)
+    n = 0
+    # one connection, and one REPEATABLE READ snapshot for every page
+    with TransactionContext():
+        columns, pk = _columns(model)
+        with _open(file_path, 'wb', compress) as data_file:
+            if format in ('csv', 'tsv'):
+                writer = csv.writer(data_file, delimiter='\t' if format == 'tsv' else ',', lineterminator='\n')
+                writer.writerow(columns)
+            elif format == 'json':
+                data_file.write('[')
+            for row in _rows(_table(model), columns, pk, chunk_size):
+                if format in ('csv', 'tsv'):
+                    writer.writerow([_csv_value(v) for v in row])
+                else:
+                    line = json.dumps(dict(zip(columns, row)), default=_json_default)
+                    if format == 'json':
+                        line = (',\n' if n else '\n') + line
+                    else:
+                        line += '\n'
+                    data_file.write(line)
+                n += 1
+            if format == 'json':
+                data_file.write('\n]\n')
+    return n
+
+
+def _read_records(data_file, format):
+    """Yield the field names and the values of every record of a data file, JSON records may name other fields"""
+    if format in ('csv', 'tsv'):
+        reader = csv.reader(data_file, delimiter='\t' if format == 'tsv' else ',')
+        names = next(reader, [])
+        for row in reader:
+            yield names, [None if v == NULL else v.decode('utf-8') for v in row]
+        return
+    if format == 'json':
+        records = json.load(data_file)
+    else:
+        records = (json.loads(line) for line in data_file if line.strip())
+    for d in records:
+        names = sorted(d)
+        yield names, [d[k] for k in names]
+
+
+def _shared_names(file_path, format, compress):
+    """Field names of the header of a data file or of all its records, None if JSON records name other fields"""
+    shared = None
+    with _open(file_path, 'rb', compress) as data_file:
+        if format in ('csv', 'tsv'):
+            return next(csv.reader(data_file, delimiter='\t' if format == 'tsv' else ','), [])
+        for names, values in _read_records(data_file, format):
+            if shared is None:
+                shared = names
+            elif names != shared:
+                return None
+    return shared or []
+
+
+def _header(model, names):
+    """Map names of a file header, attribute or column names, to columns of the model"""
+    if hasattr(model, '_column'):
+        return [model._column(name) for name in names]
+    return list(names)
+
+
+def _write_temp_csv(names, rows):
+    """Write rows into a temporary CSV file for LOAD DATA, return its path"""
+    with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as temp_file:
+        writer = csv.writer(temp_file, lineterminator='\n')
+        writer.writerow(names)
+        for row in rows:
+            writer.writerow([_csv_value(v) for v in row])
+    return temp_file.name
+
+
+def _load_infile(table, file_path, columns, delimiter, line_terminator):
+    if not columns:
+        return 0, []
+    variables = ','.join(['@c%d' % i for i in range(len(columns))])
+    assignments = ','.join(["`%s`=nullif(@c%d,'\\\\N')" % (c, i) for i, c in enumerate(columns)])
+    sql = ("load data local infile ? into table `%s` character set utf8 "
+           "fields terminated by '%s' optionally enclosed by '\"' escaped by '' "
+           "lines terminated by '%s' ignore 1 lines (%s) set %s") % (
+        table, delimiter.replace('\t', '\\t'), line_terminator.replace('\r', '\\r').replace('\n', '\\n'),
+        variables, assignments)
+    # a connection opened for the load must allow it, drivers refuse local files by default
+    with _ConnectionContext(allow_local_infile=True):
+        rows = update(sql, file_path)
+        return rows, select('show warnings')
+
+
+def _local_infile_allowed():
+    """Whether LOAD DATA LOCAL INFILE can run: on a connection opened for it, or on an open one that allows it"""
+    connection = db_context.connection
+    return connection is None or bool(connection._options.get('allow_local_infile'))
+
+
+def _local_infile_refused(e):
+    """Whether LOAD DATA LOCAL INFILE failed because the server or the client does not allow it"""
+    if e.errno in LOCAL_INFILE_ERRORS:
+        return True
+    # the pure Python client leaves the server waiting for the file: only a connection opened for the load, and
+    # closed since, is safe to give up
+    return e.errno == CLIENT_REFUSED and db_context.connection is None
+
+
+@with_connection
+def _load_inserts(model, table, records, batch_size):
+    n, warnings = 0, []
+    # consecutive records of the same fields go in one batch, left out fields get their column defaults
+    for names, group in itertools.groupby(records, lambda r: r[0]):
+        columns = _header(model, names)
+        rows = (values for _, values in group)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            n += insert_many(table, columns, batch)
+            warnings.extend(select('show warnings'))
+    return n, warnings
+
+
+def load_data(model, file_path, format=None, compress=None, local_infile=True, batch_size=500):
+    """
+    Load all records of a json, jsonl, csv or tsv file into a model or table, format and compression as in
+    dump_data. The file header, or the keys of each JSON record, name the fields, NULL is written as \\N.
+
+    Rows are loaded with LOAD DATA LOCAL INFILE, JSON and compressed files through a temporary CSV file, on a
+    connection that allows local files, unless one is already open without them. If the server or client
+    disallows it, local_infile is False, or JSON records name different fields, they are inserted with batched
+    multi-row inserts. Return a Dict with the number of rows loaded, the warnings and the method used.
+    """
+    format = _format(file_path, format)
+    compressed = compress or (compress is None and file_path.endswith('.gz'))
+    table = _table(model)
+    temp_path = None
+    try:
+        if local_infile and not _local_infile_allowed():
+            logging.info('the open connection does not allow LOAD DATA LOCAL INFILE, load with inserts')
+            local_infile = False
+        names = _shared_names(file_path, format, compress) if local_infile else None
+        if names is not None:
+            if format in ('csv', 'tsv') and not compressed:
+                infile, delimiter = file_path, '\t' if format == 'tsv' else ','
+                with open(file_path, 'rb') as data_file:
+                    line_terminator = '\r\n' if data_file.readline().endswith('\r\n') else '\n'
+            else:
+                with _open(file_path, 'rb', compress) as data_file:
+                    rows = (values for _, values in _read_records(data_file, format))
+                    temp_path = infile = _write_temp_csv(names, rows)
+                delimiter, line_terminator = ',', '\n'
+            try:
+                n, warnings = _load_infile(table, infile, _header(model, names), delimiter, line_terminator)
+                return Dict(rows=n, warnings=warnings, method='load data')
+            except mysql.connector.Error as e:
+                if not _local_infile_refused(e):
+                    raise
+                logging.warning('LOAD DATA LOCAL INFILE is not allowed, fall back to inserts: %s' % e)
+        elif local_infile:
+            logging.info('records of %s name different fields, load them with inserts' % file_path)
+        with _open(file_path, 'rb', compress) as data_file:
+            n, warnings = _load_inserts(model, table, _read_records(data_file, format), batch_size)
+        return Dict(rows=n, warnings=warnings, method='insert')
+    finally:
+        if temp_path:
+            os.remove(temp_path)
@@ -7,6 +7,10 @@ class ModelError(Exception):
     pass
 
 
+# aggregate functions supported by Model.aggregate
+AGGREGATES = ('count', 'sum', 'avg', 'min', 'max')
+
+
 class ModelMetaClass(type):
     """Metaclass for all models."""
 
@@ -18,6 +22,7 @@ class ModelMetaClass(type):
             return type.__new__(cls, name, bases, attrs)
         primary_key = None
         fields = dict()
+        meta = attrs.pop('Meta', None)
         # if table name not defined, set as the name of the class
         if '__table_name__' not in attrs:
             attrs['__table_name__'] = name.lower()
@@ -30,8 +35,6 @@ class ModelMetaClass(type):
                 if v.primary_key:
                     if primary_key:
                         raise ModelError("duplicate primary keys!")
-                    v.editable = False
-                    v.not_null = True
                     primary_key = v
                 fields[k] = v
                 # delete fields from attributes
@@ -39,14 +42,63 @@ class ModelMetaClass(type):
         # if there is no primary_key, add an autoField
         if not primary_key:
             if 'id' not in attrs:
-                fields['id'] = AutoPrimaryKeyField()
+                primary_key = fields['id'] = AutoPrimaryKeyField()
             else:
                 raise ModelError('Primary key not defined!')
+        primary_key.editable = False
+        primary_key.not_null = True
+        indexes = list(getattr(meta, 'indexes', []))
+        # opt-in modification timestamps and tombstones for incremental change fetching
+        if getattr(meta, 'track_changes', False):
+            if 'updated_at' not in fields:
+                fields['updated_at'] = TimestampField(name='updated_at', auto_now=True)
+            pk = [k for k, v in fields.items() if v is primary_key][0]
+            indexes.append(Index(['updated_at', pk]))
+        if getattr(meta, 'tombstones', False) and 'deleted' not in fields:
+            fields['deleted'] = BooleanField(name='deleted', editable=False)
+        for index in indexes:
+            for f in index.fields:
+                if f not in fields:
+                    raise ModelError("index field %s is not defined!" % f)
+            if index.name is None:
+                index.name = ('uniq_' if index.unique else 'idx_') + '_'.join(fields[f].name for f in index.fields)
         attrs['__primary_key__'] = primary_key
         attrs['__fields__'] = fields
+        attrs['__indexes__'] = indexes
+        attrs['__updated_at__'] = fields['updated_at'].name if getattr(meta, 'track_changes', False) else None
+        attrs['__tombstone__'] = fields['deleted'].name if getattr(meta, 'tombstones', False) else None
+        # columns left out of reads by default and loaded on first access
+        attrs['__deferred__'] = [f.name for f in fields.values()
+                                 if getattr(meta, 'defer_text_fields', False) and isinstance(f, TextField)]
         return type.__new__(cls, name, bases, attrs)
 
 
+class _DeferredLoader(object):
+    """Load a deferred column for every object of a result set with one query on first access."""
+
+    def __init__(self, model, objects, columns):
+        self.model = model
+        self.objects = objects
+        self.columns = set(columns)
+        # load from the engine the objects were read from
+        self.connector = db.db_context.connector
+
+    def load(self, column):
+        pk = self.model.__primary_key__.name
+        pending = [o for o in self.objects if column not in o]
+        values = dict()
+        with db.EngineContext(self.connector):
+            for i in range(0, len(pending), 1000):
+                pks = [dict.__getitem__(o, pk) for o in pending[i:i + 1000]]
+                sql = 'select `%s`,`%s` from %s where `%s` in (%s)' % (
+                    pk, column, self.model.__table_name__, pk, ','.join(['?'] * len(pks)))
+                for r in db.select(sql, *pks):
+                    values[r[pk]] = r[column]
+        for o in pending:
+            dict.__setitem__(o, column, values.get(dict.__getitem__(o, pk)))
+        self.columns.discard(column)
+
+
 class Model(Dict):
     """Base Model class represent table in Database"""
     __metaclass__ = ModelMetaClass
@@ -54,6 +106,19 @@ class Model(Dict):
     def __init__(self, **kwargs):
         super(Model, self).__init__(**kwargs)
 
+    def __missing__(self, key):
+        # load deferred columns on first access
+        loader = self.__dict__.get('_deferred_loader')
+        if loader is None or key not in loader.columns:
+            raise KeyError(key)
+        loader.load(key)
+        return dict.__getitem__(self, key)
+
+    def _is_deferred(self, column):
+        """Whether the column was deferred and has not been loaded yet"""
+        loader = self.__dict__.get('_deferred_loader')
+        return loader is not None and column in loader.columns and column not in self
+
     @classmethod
     def create_table_sql(cls):
         """generate create table SQL"""
@@ -74,6 +139,11 @@ class Model(Dict):
                 sql.append('%s %s' % (field.name, field.data_type))
             if field.not_null:
                 sql.append(' NOT NULL')
+            if getattr(field, 'auto_now', False):
+                sql.append(' DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)')
+            # rows written without the model, as by load_data, are live
+            if field.name == cls.__tombstone__:
+                sql.append(' DEFAULT 0')
             sql.append(',\n')
         sql.append('  primary key( %s )\n' % cls.__primary_key__.name)
         sql.extend(constraints)
@@ -90,15 +160,37 @@ class Model(Dict):
     @classmethod
     def create_index_sql(cls):
         sql = []
-        sql_create_index = "CREATE INDEX %(name)s ON %(table)s (%(columns)s);"
+        sql_create_index = "CREATE %(unique)sINDEX %(name)s ON %(table)s (%(columns)s);"
         for field in cls.__fields__.values():
-            # if we have a index on field
-            if field.db_index:
+            # if we have a unique or plain index on field
+            if field.unique and not field.primary_key:
+                sql.append(sql_create_index % {
+                    "unique": "UNIQUE ",
+                    "name": "uniq_" + field.name,
+                    "table": cls.__table_name__,
+                    "columns": field.name
+                })
+            elif field.db_index:
                 sql.append(sql_create_index % {
+                    "unique": "",
                     "name": "idx_" + field.name,
                     "table": cls.__table_name__,
                     "columns": field.name
                 })
+        # composite, unique and prefix indexes declared in Meta.indexes
+        for index in cls.__indexes__:
+            columns = []
+            for f in index.fields:
+                column = cls.__fields__[f].name
+                if f in index.lengths:
+                    column += '(%d)' % index.lengths[f]
+                columns.append(column)
+            sql.append(sql_create_index % {
+                "unique": "UNIQUE " if index.unique else "",
+                "name": index.name,
+                "table": cls.__table_name__,
+                "columns": ', '.join(columns)
+            })
         return sql
 
     @classmethod
@@ -127,53 +219,216 @@ class Model(Dict):
             db.update(sql)
 
     @classmethod
-    def get_by_pk(cls, pk):
+    def _select_columns(cls, only=None, defer=None):
+        """Get columns to select and columns to defer for a read"""
+        pk = cls.__primary_key__.name
+        columns = [f.name for f in cls.__fields__.values()]
+        if only is not None:
+            selected = set(cls._column(c) for c in only)
+            selected.add(pk)
+            deferred = set(c for c in columns if c not in selected)
+        else:
+            deferred = set(cls.__deferred__)
+            deferred.update(cls._column(c) for c in defer or ())
+            deferred.discard(pk)
+        return [c for c in columns if c not in deferred], deferred
+
+    @classmethod
+    def _read(cls, where, args, single=False, only=None, defer=None):
+        """Execute a read, leaving deferred columns to be loaded on first access"""
+        where = cls._live_where(where)
+        columns, deferred = cls._select_columns(only, defer)
+        select_list = ','.join(['`%s`' % c for c in columns]) if deferred else '*'
+        sql = 'select %s from %s%s' % (select_list, cls.__table_name__, where)
+        if single:
+            r = db.select_one(sql, *args)
+            rows = [r] if r else []
+        else:
+            rows = db.select(sql, *args)
+        objects = [cls(**r) for r in rows]
+        if deferred and objects:
+            loader = _DeferredLoader(cls, objects, deferred)
+            for o in objects:
+                o.__dict__['_deferred_loader'] = loader
+        if single:
+            return objects[0] if objects else None
+        return objects
+
+    @classmethod
+    def get_by_pk(cls, pk, only=None, defer=None):
         """Get by primary key"""
-        sql = 'select * from %s where %s=?' % (cls.__table_name__, cls.__primary_key__.name)
-        return cls(**db.select_one(sql, pk))
+        return cls._read(' where %s=?' % cls.__primary_key__.name, [pk], True, only, defer)
 
     @classmethod
     def get(cls, **kwargs):
-        """Get by attribute"""
+        """Get by attribute, only and defer select columns to load"""
+        only, defer = kwargs.pop('only', None), kwargs.pop('defer', None)
         if len(kwargs) != 1:
             raise TypeError("invalid number of attributes")
-        sql = 'select * from %s where %s=?' % (cls.__table_name__, kwargs.keys()[0])
-        return [cls(**r) for r in db.select(sql, kwargs.values()[0])]
+        return cls._read(' where %s=?' % kwargs.keys()[0], kwargs.values(), False, only, defer)
 
     @classmethod
-    def get_all(cls):
+    def get_all(cls, only=None, defer=None):
         """Get all tuples"""
-        sql = 'select * from %s' % cls.__table_name__
-        return [cls(**r) for r in db.select(sql)]
+        return cls._read('', [], False, only, defer)
 
     @classmethod
     def get_first(cls, **kwargs):
         """Get by attribute, return only the first result"""
+        only, defer = kwargs.pop('only', None), kwargs.pop('defer', None)
         if len(kwargs) != 1:
             raise TypeError("invalid number of attributes")
-        sql = 'select * from %s where %s=?' % (cls.__table_name__, kwargs.keys()[0])
-        return cls(**db.select_one(sql, kwargs.values()[0]))
+        return cls._read(' where %s=?' % kwargs.keys()[0], kwargs.values(), True, only, defer)
+
+    @classmethod
+    def values_list(cls, *fields, **kwargs):
+        """
+        Get rows as tuples of the given fields (all fields if none given), or with flat=True a flat list of
+        a single field. Other keyword arguments filter by attribute.
+        """
+        flat = kwargs.pop('flat', False)
+        if flat and len(fields) != 1:
+            raise TypeError("flat requires exactly one field")
+        columns = [cls._column(f) for f in fields] or [f.name for f in cls.__fields__.values()]
+        where_sql, args = cls._where_sql(kwargs)
+        sql = 'select %s from %s%s' % (','.join(['`%s`' % c for c in columns]), cls.__table_name__, where_sql)
+        if flat:
+            return db.select_column(sql, *args)
+        return db.select_tuples(sql, *args)
 
     @classmethod
     def count(cls, **kwargs):
         """Count by attribute"""
         if len(kwargs) != 1:
             raise TypeError("invalid number of attributes")
-        sql = 'select count(*) from %s where %s=?' % (cls.__table_name__, kwargs.keys()[0])
+        sql = 'select count(*) from %s%s' % (cls.__table_name__, cls._live_where(' where %s=?' % kwargs.keys()[0]))
         return db.select_int(sql, kwargs.values()[0])
 
     @classmethod
     def count_all(cls):
         """Count by attribute"""
-        sql = 'select count(*) from %s' % cls.__table_name__
+        sql = 'select count(*) from %s%s' % (cls.__table_name__, cls._live_where(''))
         return db.select_int(sql)
 
+    @classmethod
+    def changed_since(cls, since=None, chunk_size=500, lag=5):
+        """
+        Yield objects inserted, updated or tombstoned after since, in (updated_at, primary key) order. since is a
+        datetime, a unix timestamp or the change_cursor() of the last object seen; None yields every row.
+
+        updated_at is set when a statement runs, but the row only shows once its transaction commits. Changes of
+        the last lag seconds are therefore left for the next call; a change committed more than lag seconds after
+        its statement ran can still be missed.
+        """
+        if not cls.__updated_at__:
+            raise ModelError("%s does not track changes!" % cls.__name__)
+        ts, pk = cls.__updated_at__, cls.__primary_key__.name
+        last_ts, last_pk = since if isinstance(since, tuple) else (since, None)
+        # unix timestamps are converted in the time zone of the session, as updated_at is
+        value = 'from_unixtime(?)' if isinstance(last_ts, (int, long, float)) else '?'
+        while True:
+            where, args = '`%s`<=now(6)-interval ? microsecond' % ts, [int(lag * 1000000)]
+            if last_ts is not None and last_pk is None:
+                where += ' and `%s`>%s' % (ts, value)
+                args.append(last_ts)
+            elif last_ts is not None:
+                where += ' and `%s`>=%s and (`%s`>%s or `%s`>?)' % (ts, value, ts, value, pk)
+                args.extend([last_ts, last_ts, last_pk])
+            sql = 'select * from %s where %s order by `%s`,`%s` limit ?' % (cls.__table_name__, where, ts, pk)
+            rows = db.select(sql, *(args + [chunk_size]))
+            for r in rows:
+                yield cls(**r)
+            if len(rows) < chunk_size:
+                return
+            last_ts, last_pk, value = rows[-1][ts], rows[-1][pk], '?'
+
+    def change_cursor(self):
+        """Get the cursor that resumes changed_since after this object"""
+        return self[self.__updated_at__], self[self.__primary_key__.name]
+
+    @classmethod
+    def _column(cls, name):
+        """Get column name of a field by attribute or column name"""
+        if name in cls.__fields__:
+            return cls.__fields__[name].name
+        for field in cls.__fields__.values():
+            if field.name == name:
+                return name
+        raise ModelError("field %s is not defined!" % name)
+
+    @classmethod
+    def _live_where(cls, where):
+        """Add the filter hiding tombstoned rows to a where clause"""
+        if not cls.__tombstone__:
+            return where
+        live = '`%s`=0' % cls.__tombstone__
+        return '%s and %s' % (where, live) if where else ' where %s' % live
+
+    @classmethod
+    def _where_sql(cls, filters):
+        """Generate where clause and its arguments for equality filters"""
+        if not filters:
+            return cls._live_where(''), []
+        columns, args = zip(*filters.items())
+        where = ' where %s' % ' and '.join(['`%s`=?' % cls._column(c) for c in columns])
+        return cls._live_where(where), list(args)
+
+    @classmethod
+    def _delete_sql(cls, where):
+        """Generate SQL deleting the rows of a where clause, or tombstoning them"""
+        if cls.__tombstone__:
+            return 'update %s set `%s`=1%s' % (cls.__table_name__, cls.__tombstone__, cls._live_where(where))
+        return 'delete from %s%s' % (cls.__table_name__, where)
+
+    @classmethod
+    def aggregate(cls, group_by=None, having=None, where=None, **aggregates):
+        """
+        Compute aggregates in the database, e.g.
+        Sailor.aggregate(avg='age', max=['rating', 'age'], count='*', group_by='rating', having=('count_all > ?', 1))
+
+        Results are named <function>_<field> (count='*' is count_all). Return one Dict, or a list of Dicts that
+        also hold the group_by fields when grouping. where is a dict of equality filters, having a SQL string or
+        a (SQL, args...) tuple.
+        """
+        if not aggregates:
+            raise TypeError("no aggregate given")
+        if isinstance(group_by, basestring):
+            group_by = [group_by]
+        group_by = [cls._column(g) for g in group_by or []]
+        columns = ['`%s`' % g for g in group_by]
+        for func in sorted(aggregates):
+            if func not in AGGREGATES:
+                raise TypeError("unsupported aggregate %s" % func)
+            names = aggregates[func]
+            if isinstance(names, basestring):
+                names = [names]
+            for name in names:
+                if name == '*':
+                    columns.append('%s(*) as `%s_all`' % (func, func))
+                else:
+                    column = cls._column(name)
+                    columns.append('%s(`%s`) as `%s_%s`' % (func, column, func, column))
+        where_sql, args = cls._where_sql(where)
+        sql = 'select %s from %s%s' % (','.join(columns), cls.__table_name__, where_sql)
+        if group_by:
+            sql += ' group by %s' % ','.join(['`%s`' % g for g in group_by])
+        if having:
+            if isinstance(having, basestring):
+                having = (having,)
+            sql += ' having %s' % having[0]
+            args.extend(having[1:])
+        if not group_by:
+            return db.select_one(sql, *args)
+        sql += ' order by %s' % ','.join(['`%s`' % g for g in group_by])
+        return db.select(sql, *args)
+
     def update_all(self):
         """Update all attributes in the tuple"""
         L = []
         args = []
         for k, v in self.__fields__.items():
-            if v.editable:
+            # unloaded deferred columns are unchanged
+            if v.editable and not self._is_deferred(v.name):
                 if hasattr(self, k):
                     arg = getattr(self, k)
                 else:
@@ -191,6 +446,9 @@ class Model(Dict):
         params = {}
         for k, v in self.__fields__.items():
             if not hasattr(self, k):
+                # left to the database
+                if getattr(v, 'auto_now', False):
+                    continue
                 setattr(self, k, v.default)
             params[v.name] = getattr(self, k)
         db.insert('%s' % self.__table_name__, **params)
@@ -200,13 +458,13 @@ class Model(Dict):
         """Delete the object in table"""
         pk = self.__primary_key__.name
         args = (getattr(self, pk),)
-        db.update('delete from %s where %s=?' % (self.__table_name__, pk), *args)
+        db.update(self._delete_sql(' where %s=?' % pk), *args)
         return self
 
     @classmethod
     def delete_by_pk(cls, pk):
         """Delete by primary key"""
-        db.update('delete from %s where %s=?' % (cls.__table_name__, cls.__primary_key__.name), pk)
+        db.update(cls._delete_sql(' where %s=?' % cls.__primary_key__.name), pk)
         return
 
     @classmethod
@@ -214,5 +472,5 @@ class Model(Dict):
         """Delete by attribute"""
         if len(kwargs) != 1:
             raise TypeError("invalid number of attributes")
-        sql = 'delete from %s where %s=?' % (cls.__table_name__, kwargs.keys()[0])
+        sql = cls._delete_sql(' where %s=?' % kwargs.keys()[0])
         return db.update(sql, kwargs.values()[0])
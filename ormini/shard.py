@@ -0,0 +1,236 @@
+import bisect
+import threading
+import zlib
+import db
+
+# global shard connectors by name:
+shards = dict()
+
+
+class ShardError(db.DateBaseError):
+    pass
+
+
+def add_shard(name, user, password, database, host='127.0.0.1', port=3306, **kw):
+    """Configure a named shard, with the same parameters as init_engine"""
+    if name in shards:
+        raise ShardError('Shard %s is already initialized.' % name)
+    shards[name] = db.create_connector(user, password, database, host, port, **kw)
+
+
+def close_shards():
+    shards.clear()
+
+
+def using_shard(name):
+    """Context object that runs the statements of the current thread on the named shard"""
+    if name not in shards:
+        raise ShardError('Shard %s is not initialized.' % name)
+    return db.EngineContext(shards[name])
+
+
+def _writing_shard(name):
+    """Context object for a write on the named shard, which could not take part in a transaction of another engine"""
+    if db.db_context.transactions and db.db_context.connector is not shards.get(name):
+        raise ShardError('Can not write to shard %s inside a transaction on another engine.' % name)
+    return using_shard(name)
+
+
+def _iter_on_shard(name, iterator):
+    """Advance an iterator that runs statements on the named shard, leaving the engine of the caller in between"""
+    while True:
+        with using_shard(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def scatter(names, func, *args, **kw):
+    """Run func on each named shard in parallel threads, return the results in the order of names"""
+    results = [None] * len(names)
+    errors = []
+    # the deadline of the caller bounds the statements of every shard
+    deadline = db.db_context.deadline
+
+    def run(i, name):
+        db.db_context.deadline = deadline
+        try:
+            with using_shard(name):
+                results[i] = func(*args, **kw)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i, name)) for i, name in enumerate(names)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+class HashShardMap(object):
+    """Map shard keys to shards by a stable hash of the key"""
+
+    def __init__(self, names):
+        self.names = list(names)
+
+    def shard(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return self.names[(zlib.crc32(str(key)) & 0xffffffff) % len(self.names)]
+
+
+class RangeShardMap(object):
+    """
+    Map shard keys to shards by ranges, given as (lower bound, shard name) pairs. A key belongs to the shard of the
+    greatest lower bound not above it.
+    RangeShardMap([(0, 's0'), (1000, 's1')])
+    """
+
+    def __init__(self, ranges):
+        ranges = sorted(ranges)
+        self.bounds = [r[0] for r in ranges]
+        self.names = [r[1] for r in ranges]
+
+    def shard(self, key):
+        i = bisect.bisect_right(self.bounds, key) - 1
+        if i < 0:
+            raise ShardError('shard key %r is below every range' % (key,))
+        return self.names[i]
+
+
+class Sharded(object):
+    """
+    Mixin that spreads a model across shards by the value of its __shard_key__ field, through its __shard_map__.
+    Lookups on the shard key run on one shard, other reads run on every shard in parallel and merge the results.
+    Writes inside a transaction raise ShardError unless the transaction runs on their shard, with using_shard.
+
+    class Sailor(Sharded, Model):
+        __shard_key__ = 'sid'
+        __shard_map__ = HashShardMap(['s0', 's1'])
+    """
+    __shard_key__ = None
+    __shard_map__ = None
+
+    @classmethod
+    def _all_shards(cls):
+        return sorted(set(cls.__shard_map__.names))
+
+    @classmethod
+    def _route(cls, filters):
+        """Get the only shard matching equality filters on attributes, None if they do not include the shard key"""
+        key = cls._column(cls.__shard_key__)
+        for k, v in filters.items():
+            if cls._column(k) == key:
+                return cls.__shard_map__.shard(v)
+        return None
+
+    @classmethod
+    def _on_shards(cls, filters, func, *args, **kw):
+        """Run func on the shard of the filters, or on all shards; return the list of results"""
+        shard = cls._route(filters)
+        if shard is not None:
+            with using_shard(shard):
+                return [func(*args, **kw)]
+        return scatter(cls._all_shards(), func, *args, **kw)
+
+    @classmethod
+    def _write_on_shards(cls, filters, func, *args, **kw):
+        """Run the write func on the shard of the filters, or on all shards; return the list of results"""
+        shard = cls._route(filters)
+        if shard is not None:
+            with _writing_shard(shard):
+                return [func(*args, **kw)]
+        if db.db_context.transactions:
+            raise ShardError('Can not write to every shard inside a transaction.')
+        return scatter(cls._all_shards(), func, *args, **kw)
+
+    @classmethod
+    def _merge(cls, results):
+        """Merge lists of objects read from several shards in primary key order"""
+        pk = cls.__primary_key__.name
+        return sorted([o for r in results for o in r], key=lambda o: dict.__getitem__(o, pk))
+
+    @classmethod
+    def _first(cls, results):
+        found = [o for o in results if o is not None]
+        return cls._merge([found])[0] if found else None
+
+    @classmethod
+    def create_table(cls):
+        scatter(cls._all_shards(), super(Sharded, cls).create_table)
+
+    @classmethod
+    def get_by_pk(cls, pk, only=None, defer=None):
+        results = cls._on_shards({cls.__primary_key__.name: pk}, super(Sharded, cls).get_by_pk, pk, only, defer)
+        return cls._first(results)
+
+    @classmethod
+    def get(cls, **kwargs):
+        filters = dict((k, v) for k, v in kwargs.items() if k not in ('only', 'defer'))
+        return cls._merge(cls._on_shards(filters, super(Sharded, cls).get, **kwargs))
+
+    @classmethod
+    def get_all(cls, only=None, defer=None):
+        return cls._merge(scatter(cls._all_shards(), super(Sharded, cls).get_all, only, defer))
+
+    @classmethod
+    def get_first(cls, **kwargs):
+        filters = dict((k, v) for k, v in kwargs.items() if k not in ('only', 'defer'))
+        return cls._first(cls._on_shards(filters, super(Sharded, cls).get_first, **kwargs))
+
+    @classmethod
+    def values_list(cls, *fields, **kwargs):
+        filters = dict((k, v) for k, v in kwargs.items() if k != 'flat')
+        results = cls._on_shards(filters, super(Sharded, cls).values_list, *fields, **kwargs)
+        return [r for result in results for r in result]
+
+    @classmethod
+    def count(cls, **kwargs):
+        return sum(cls._on_shards(kwargs, super(Sharded, cls).count, **kwargs))
+
+    @classmethod
+    def count_all(cls):
+        return sum(scatter(cls._all_shards(), super(Sharded, cls).count_all))
+
+    @classmethod
+    def aggregate(cls, group_by=None, having=None, where=None, **aggregates):
+        shard = cls._route(where or {})
+        if shard is None:
+            raise ShardError('aggregate needs a where filter on the shard key of a sharded model')
+        with using_shard(shard):
+            return super(Sharded, cls).aggregate(group_by, having, where, **aggregates)
+
+    @classmethod
+    def changed_since(cls, since=None, chunk_size=500, lag=5, shard=None):
+        """Yield the changes of one shard, named by shard, as Model.changed_since: cursors do not span shards"""
+        if shard is None:
+            raise ShardError('changed_since of a sharded model reads one shard, given by shard=')
+        return _iter_on_shard(shard, super(Sharded, cls).changed_since(since, chunk_size, lag))
+
+    def _shard(self):
+        return _writing_shard(self.__shard_map__.shard(getattr(self, self.__shard_key__)))
+
+    def update_all(self):
+        with self._shard():
+            return super(Sharded, self).update_all()
+
+    def insert(self):
+        with self._shard():
+            return super(Sharded, self).insert()
+
+    def delete(self):
+        with self._shard():
+            return super(Sharded, self).delete()
+
+    @classmethod
+    def delete_by_pk(cls, pk):
+        cls._write_on_shards({cls.__primary_key__.name: pk}, super(Sharded, cls).delete_by_pk, pk)
+
+    @classmethod
+    def delete_by_attr(cls, **kwargs):
+        return sum(cls._write_on_shards(kwargs, super(Sharded, cls).delete_by_attr, **kwargs))
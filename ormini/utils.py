@@ -1,3 +1,6 @@
+import re
+
+
 class Dict(dict):
     """dict with d.x feature"""
 
@@ -13,4 +16,17 @@ class Dict(dict):
             raise AttributeError(r"Dict object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
-        self[key] = value
\ No newline at end of file
+        self[key] = value
+
+
+_literal_re = re.compile(r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|\b\d+(?:\.\d+)?\b""")
+_in_list_re = re.compile(r"\bin\s*\((?:\s*\?\s*,)*\s*\?\s*\)", re.IGNORECASE)
+_space_re = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    """Reduce SQL to its statement shape: literals and placeholders become ?, whitespace is collapsed."""
+    shape = sql.replace('%s', '?')
+    shape = _literal_re.sub('?', shape)
+    shape = _in_list_re.sub('in (?)', shape)
+    return _space_re.sub(' ', shape).strip().lower()
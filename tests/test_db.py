@@ -1,9 +1,22 @@
 from unittest import TestCase
 from ormini.db import *
 from config import configs
+import os
+import subprocess
+import sys
+import threading
 import time
 
 
+def _select_scalar_in_thread(sql, *args):
+    """Run select_scalar on a new connection of another thread."""
+    result = []
+    t = threading.Thread(target=lambda: result.append(select_scalar(sql, *args)))
+    t.start()
+    t.join()
+    return result[0]
+
+
 class DBTests(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -39,6 +52,46 @@ class DBTests(TestCase):
         r = select('select * from user where name=?', 'Ma')
         self.assertEqual('Ma', r[0].passwd)
 
+    def test_commit_window(self):
+        with CommitWindowContext(max_statements=2, max_delay=60000) as window:
+            insert('user', id=1, name='Chao', email='111@test.org', passwd='pass1', last_modified=time.time())
+            self.assertEqual(1, window.pending)
+            self.assertEqual(0, _select_scalar_in_thread('select count(*) from user'))
+            insert('user', id=2, name='Ma', email='111@test.org', passwd='pass2', last_modified=time.time())
+            self.assertEqual(0, window.pending)
+            self.assertEqual(2, _select_scalar_in_thread('select count(*) from user'))
+            update('update user set passwd=? where id=?', 'new_pass', 1)
+            self.assertEqual(1, window.pending)
+        self.assertEqual('new_pass', _select_scalar_in_thread('select passwd from user where id=?', 1))
+
+    def test_commit_window_delay(self):
+        with CommitWindowContext(max_statements=100, max_delay=0) as window:
+            insert('user', id=1, name='Chao', email='111@test.org', passwd='pass1', last_modified=time.time())
+            self.assertEqual(0, window.pending)
+
+    def test_commit_window_delay_on_read(self):
+        with CommitWindowContext(max_statements=100, max_delay=100) as window:
+            insert('user', id=1, name='Chao', email='111@test.org', passwd='pass1', last_modified=time.time())
+            self.assertEqual(1, window.pending)
+            time.sleep(0.2)
+            select('select * from user')
+            self.assertEqual(0, window.pending)
+            self.assertEqual(1, _select_scalar_in_thread('select count(*) from user'))
+
+    def test_commit_window_transaction(self):
+        @with_commit_window(max_statements=100, max_delay=60000)
+        def write():
+            insert('user', id=1, name='Chao', email='111@test.org', passwd='pass1', last_modified=time.time())
+            try:
+                with TransactionContext():
+                    insert('user', id=2, name='Ma', email='111@test.org', passwd='pass2', last_modified=time.time())
+                    raise ValueError()
+            except ValueError:
+                pass
+
+        write()
+        self.assertEqual(1, _select_scalar_in_thread('select count(*) from user'))
+
     def test_select_one(self):
         u1 = dict(id=1, name='Chao', email='111@test.org', passwd='pass1', last_modified=time.time())
         insert('user', **u1)
@@ -68,6 +121,24 @@ class DBTests(TestCase):
         self.assertEqual('Chao', r[0].name)
         self.assertEqual('Ma', r[1].name)
 
+    def test_select_tuples(self):
+        insert('user', id=1, name='Chao', email='111@test.org', passwd='pass1', last_modified=time.time())
+        insert('user', id=2, name='Ma', email='111@test.org', passwd='pass2', last_modified=time.time())
+        r = select_tuples('select id, name from user order by id')
+        self.assertEqual([(1, 'Chao'), (2, 'Ma')], [tuple(x) for x in r])
+
+    def test_select_column(self):
+        insert('user', id=1, name='Chao', email='111@test.org', passwd='pass1', last_modified=time.time())
+        insert('user', id=2, name='Ma', email='111@test.org', passwd='pass2', last_modified=time.time())
+        self.assertEqual(['Chao', 'Ma'], select_column('select name from user order by id'))
+        self.assertRaises(MultiColumnsError, lambda: select_column('select id, name from user'))
+
+    def test_select_scalar(self):
+        insert('user', id=1, name='Chao', email='111@test.org', passwd='pass1', last_modified=time.time())
+        self.assertEqual('Chao', select_scalar('select name from user where id=?', 1))
+        self.assertEqual(None, select_scalar('select name from user where id=?', 2))
+        self.assertRaises(MultiColumnsError, lambda: select_scalar('select id, name from user'))
+
     def test_insert(self):
         u1 = dict(id=1, name='Chao', email='111@test.org', passwd='pass1', last_modified=time.time())
         insert('user', **u1)
@@ -82,3 +153,87 @@ class DBTests(TestCase):
         update('update user set passwd=? where id=?', 'newpass', 1)
         r = select('select * from user')
         self.assertEqual('newpass', r[0].passwd)
+
+    def test_fork(self):
+        @with_connection
+        def fork_workers(workers):
+            own = select_int('select connection_id()')
+            children = []
+            for _ in range(workers):
+                r, w = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        os.write(w, str(select_int('select connection_id()')))
+                    finally:
+                        os._exit(0)
+                os.close(w)
+                children.append((pid, r))
+            ids = []
+            for pid, r in children:
+                os.waitpid(pid, 0)
+                ids.append(int(os.read(r, 32)))
+                os.close(r)
+            # parent connection still usable after children exit
+            self.assertEqual(own, select_int('select connection_id()'))
+            return own, ids
+
+        own, ids = fork_workers(3)
+        self.assertNotIn(own, ids)
+        self.assertEqual(3, len(set(ids)))
+
+    def test_fork_child_exits_normally(self):
+        # children that exit through sys.exit free their copy of the connection on interpreter shutdown
+        script = '\n'.join([
+            'import os, sys',
+            'from ormini.db import *',
+            'from config import configs',
+            "init_engine(use_pure=sys.argv[1] == 'pure', **configs['testDB'])",
+            '@with_connection',
+            'def main():',
+            "    own = select_int('select connection_id()')",
+            '    for query in (True, False):',
+            '        pid = os.fork()',
+            '        if pid == 0:',
+            '            if query:',
+            "                select_int('select connection_id()')",
+            '            sys.exit(0)',
+            '        os.waitpid(pid, 0)',
+            "    print(own == select_int('select connection_id()'))",
+            'main()'])
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for driver in ('pure', 'cext'):
+            output = subprocess.check_output([sys.executable, '-c', script, driver], cwd=root)
+            self.assertEqual('True', output.strip())
+
+    def test_statement_timeout(self):
+        insert('user', id=1, name='Chao', email='111@test.org', passwd='pass1', last_modified=time.time())
+        start = time.time()
+        self.assertRaises(QueryTimeoutError, lambda: select('select sleep(?) from user', 5, timeout=0.2))
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(1, select_int('select count(*) from user', timeout=1))
+
+    def test_statement_timeout_watchdog(self):
+        for _ in range(20):
+            self.assertEqual(1, select_int('select 1', timeout=5))
+        self.assertEqual(1, len([t for t in threading.enumerate() if t.name == 'ormini-watchdog']))
+
+    def test_transaction_deadline(self):
+        insert('user', id=1, name='Chao', email='111@test.org', passwd='pass1', last_modified=time.time())
+
+        def slow_transaction():
+            with TransactionContext(timeout=0.5):
+                update('update user set passwd=? where id=?', 'new_pass', 1)
+                select('select sleep(?) from user', 5)
+
+        self.assertRaises(QueryTimeoutError, slow_transaction)
+        self.assertEqual('pass1', select_one('select * from user where id=?', 1).passwd)
+
+    def test_connection_deadline(self):
+        @with_connection(timeout=0.1)
+        def late():
+            time.sleep(0.2)
+            return select_int('select count(*) from user')
+
+        self.assertRaises(QueryTimeoutError, late)
+        self.assertEqual(0, select_int('select count(*) from user'))
@@ -0,0 +1,120 @@
+import threading
+from unittest import TestCase
+from ormini.db import *
+from ormini.models import *
+from ormini.fields import *
+from ormini.diagnostics import QueryInspector, NPlusOneDetector, NPlusOneError
+from config import configs
+
+
+class Course(Model):
+    id = IntegerField(primary_key=True)
+    title = CharField(db_index=True)
+    room = CharField(max_length=20)
+
+
+class QueryInspectorTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if not db.connector:
+            init_engine(**configs['testDB'])
+
+    def setUp(self):
+        update('drop table if exists course')
+        Course.create_table()
+        for i in range(1, 6):
+            Course(id=i, title='c%d' % i, room='r%d' % i).insert()
+
+    def test_full_scan(self):
+        with QueryInspector() as inspector:
+            Course.get(room='r1')
+            Course.get(room='r2')
+        self.assertEqual(1, len(inspector.plans))
+        self.assertEqual('full scan', inspector.problems[0].kind)
+        self.assertEqual(['room'], inspector.problems[0].where)
+        suggestions = inspector.suggestions(Course)
+        self.assertEqual('set db_index=True on Course.room', suggestions[0].suggestion)
+        self.assertIn('Course.room', inspector.report(Course))
+
+    def test_indexed_lookup(self):
+        with QueryInspector() as inspector:
+            Course.get(title='c1')
+            Course.get_by_pk(1)
+        self.assertEqual(2, len(inspector.plans))
+        self.assertEqual([], inspector.suggestions(Course))
+
+    def test_disabled_outside_context(self):
+        with QueryInspector() as inspector:
+            pass
+        Course.get(room='r1')
+        self.assertEqual(0, len(inspector.plans))
+
+    def test_other_threads(self):
+        with QueryInspector() as inspector:
+            t = threading.Thread(target=lambda: Course.get(room='r1'))
+            t.start()
+            t.join()
+        self.assertEqual(0, len(inspector.plans))
+
+    def test_composite_suggestion(self):
+        with QueryInspector() as inspector:
+            select('select * from course where room=? order by title', 'r1')
+        suggestions = inspector.suggestions(Course)
+        self.assertIn("add Index(['room', 'title']) to Course.Meta.indexes", [s.suggestion for s in suggestions])
+
+
+class NPlusOneDetectorTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if not db.connector:
+            init_engine(**configs['testDB'])
+
+    def setUp(self):
+        update('drop table if exists course')
+        Course.create_table()
+        for i in range(1, 6):
+            Course(id=i, title='c%d' % i, room='r%d' % i).insert()
+
+    def test_raise(self):
+        def lookup():
+            with NPlusOneDetector(threshold=3, raise_error=True):
+                for i in range(1, 6):
+                    Course.get_by_pk(i)
+        self.assertRaises(NPlusOneError, lookup)
+
+    def test_below_threshold(self):
+        with NPlusOneDetector(threshold=5, raise_error=True) as detector:
+            for i in range(1, 6):
+                Course.get_by_pk(i)
+        self.assertEqual([], detector.reports)
+
+    def test_report_stack(self):
+        with NPlusOneDetector(threshold=2) as detector:
+            for i in range(1, 4):
+                Course.get_first(title='c%d' % i)
+        self.assertEqual(1, len(detector.reports))
+        self.assertIn('test_report_stack', detector.reports[0].stack)
+
+    def test_per_connection(self):
+        @with_connection
+        def lookup():
+            for i in range(1, 6):
+                Course.get_by_pk(i)
+
+        with NPlusOneDetector(threshold=3, per_connection=True) as detector:
+            for i in range(1, 6):
+                Course.get_by_pk(i)
+            self.assertEqual([], detector.reports)
+            lookup()
+            self.assertEqual(1, len(detector.reports))
+
+    def test_other_threads(self):
+        def lookup():
+            for i in range(1, 6):
+                Course.get_by_pk(i)
+
+        with NPlusOneDetector(threshold=0, raise_error=True) as detector:
+            t = threading.Thread(target=lookup)
+            t.start()
+            t.join()
+        self.assertEqual([], detector.reports)
@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from ormini.db import *
+from ormini.models import *
+from ormini.fields import *
+from ormini.load import dump_data, load_data
+from config import configs
+
+
+class Boat(Model):
+    bid = IntegerField(primary_key=True)
+    bname = CharField(max_length=20)
+    color = CharField(max_length=10, not_null=False)
+
+
+class LoadTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if not db.connector:
+            init_engine(**configs['testDB'])
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        update('drop table if exists boat')
+        Boat.create_table()
+        Boat(bid=101, bname='Interlake', color='blue').insert()
+        Boat(bid=102, bname=u'Clipper, "II"', color='red').insert()
+        insert('boat', bid=103, bname='Marine', color=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _round_trip(self, file_name, **kw):
+        path = os.path.join(self.dir, file_name)
+        expect = sorted(select_tuples('select bid, bname, color from boat'))
+        self.assertEqual(3, dump_data(Boat, path, chunk_size=2, **kw))
+        update('delete from boat')
+        r = load_data(Boat, path, **kw)
+        self.assertEqual(3, r.rows)
+        self.assertIn(r.method, ('load data', 'insert'))
+        self.assertEqual(expect, sorted(select_tuples('select bid, bname, color from boat')))
+
+    def test_json(self):
+        self._round_trip('boat.json')
+
+    def test_jsonl(self):
+        self._round_trip('boat.jsonl')
+
+    def test_csv(self):
+        self._round_trip('boat.csv')
+
+    def test_tsv(self):
+        self._round_trip('boat.tsv')
+
+    def test_load_data_infile(self):
+        path = os.path.join(self.dir, 'boat.csv')
+        dump_data(Boat, path)
+        update('delete from boat')
+        r = load_data(Boat, path)
+        self.assertEqual('load data', r.method)
+        self.assertEqual(3, r.rows)
+        self.assertEqual(3, Boat.count_all())
+
+    def test_load_in_transaction(self):
+        path = os.path.join(self.dir, 'boat.csv')
+        dump_data(Boat, path)
+        update('delete from boat')
+        with TransactionContext():
+            r = load_data(Boat, path)
+            self.assertEqual('insert', r.method)
+            self.assertEqual(3, Boat.count_all())
+        self.assertEqual(3, Boat.count_all())
+
+    def test_dump_one_connection(self):
+        connections = []
+        hook = lambda sql, args: connections.append(db_context.connection)
+        add_statement_hook(hook)
+        try:
+            self.assertEqual(3, dump_data(Boat, os.path.join(self.dir, 'boat.csv'), chunk_size=1))
+        finally:
+            remove_statement_hook(hook)
+        self.assertEqual(4, len(connections))
+        self.assertEqual(1, len(set(id(c) for c in connections)))
+
+    def test_insert_fallback(self):
+        path = os.path.join(self.dir, 'boat.csv')
+        dump_data(Boat, path)
+        update('delete from boat')
+        r = load_data(Boat, path, local_infile=False, batch_size=2)
+        self.assertEqual('insert', r.method)
+        self.assertEqual(3, r.rows)
+        self.assertEqual(3, Boat.count_all())
+
+    def test_compressed(self):
+        self._round_trip('boat.csv.gz')
+        self._round_trip('boat.dump', format='jsonl', compress=True)
+
+    def test_json_records_with_other_fields(self):
+        path = os.path.join(self.dir, 'dock.jsonl')
+        with open(path, 'w') as f:
+            f.write('{"bid": 1, "bname": "a"}\n{"bid": 2, "bname": "b", "color": "red"}\n{"bid": 3, "bname": "c"}\n')
+        update('drop table if exists dock')
+        update("create table dock (bid int primary key, bname varchar(20), color varchar(10) not null default 'grey')")
+        r = load_data('dock', path)
+        self.assertEqual('insert', r.method)
+        self.assertEqual([(1, 'a', 'grey'), (2, 'b', 'red'), (3, 'c', 'grey')],
+                         [tuple(x) for x in select_tuples('select bid, bname, color from dock order by bid')])
+        update('drop table if exists dock')
+
+    def test_table_without_primary_key(self):
+        update('drop table if exists log')
+        update('create table log (msg varchar(20))')
+        insert('log', msg='a')
+        insert('log', msg='b')
+        path = os.path.join(self.dir, 'log.jsonl')
+        self.assertEqual(2, dump_data('log', path, chunk_size=1))
+        update('delete from log')
+        load_data('log', path)
+        self.assertEqual(['a', 'b'], sorted(select_column('select msg from log')))
+        update('drop table if exists log')
+
+    def test_unsupported_format(self):
+        self.assertRaises(ValueError, lambda: dump_data(Boat, os.path.join(self.dir, 'boat.xml')))
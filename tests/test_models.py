@@ -1,3 +1,4 @@
+import time
 from unittest import TestCase
 from ormini.db import *
 from config import configs
@@ -17,6 +18,35 @@ class Professor(Model):
     student = ForeignKeyField(Student, related_field='id')
 
 
+class Enrollment(Model):
+    id = IntegerField(primary_key=True)
+    student = IntegerField()
+    term = CharField(max_length=10)
+    note = TextField()
+    code = CharField(max_length=20, unique=True)
+
+    class Meta:
+        indexes = [Index(['student', 'term'], unique=True), Index('note', lengths={'note': 32})]
+
+
+class Article(Model):
+    id = IntegerField(primary_key=True)
+    title = CharField()
+    body = TextField()
+
+    class Meta:
+        defer_text_fields = True
+
+
+class Ticket(Model):
+    tid = IntegerField(primary_key=True)
+    title = CharField(max_length=20)
+
+    class Meta:
+        track_changes = True
+        tombstones = True
+
+
 class ModelTests(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -33,6 +63,37 @@ class ModelTests(TestCase):
         expect = 'create table `student` (\nemail varchar(100),\nname varchar(255),\nid int NOT NULL,\n  primary key( id )\n);'
         self.assertEqual(expect, s.create_table_sql())
 
+    def test_implicit_primary_key(self):
+        class Tag(Model):
+            label = CharField(max_length=20)
+
+        self.assertIs(Tag.__fields__['id'], Tag.__primary_key__)
+        self.assertIn('id int NOT NULL', Tag.create_table_sql())
+        self.assertFalse(Tag.__primary_key__.editable)
+
+    def test_create_index_sql(self):
+        sql = Enrollment.create_index_sql()
+        self.assertIn('CREATE UNIQUE INDEX uniq_code ON enrollment (code);', sql)
+        self.assertIn('CREATE UNIQUE INDEX uniq_student_term ON enrollment (student, term);', sql)
+        self.assertIn('CREATE INDEX idx_note ON enrollment (note(32));', sql)
+        self.assertEqual(3, len(sql))
+
+    def test_index_unknown_field(self):
+        def define():
+            class Bad(Model):
+                id = IntegerField(primary_key=True)
+
+                class Meta:
+                    indexes = [Index(['missing'])]
+        self.assertRaises(ModelError, define)
+
+    def test_create_composite_index(self):
+        update('drop table if exists enrollment')
+        Enrollment.create_table()
+        Enrollment(id=1, student=1, term='f17', code='a').insert()
+        self.assertRaises(Exception, lambda: Enrollment(id=2, student=1, term='f17', code='b').insert())
+        update('drop table if exists enrollment')
+
     def test_create_table(self):
         u1 = dict(id=1, name='Chao', email='1@test.org')
         insert('student', **u1)
@@ -95,6 +156,84 @@ class ModelTests(TestCase):
         r = Student.count_all()
         self.assertEqual(2, r)
 
+    def test_aggregate(self):
+        for i, name in enumerate(['Chao', 'Chao', 'Ma'], 1):
+            insert('student', id=i, name=name, email='%d@test.org' % i)
+        r = Student.aggregate(count='*', sum='id', max='id')
+        self.assertEqual(3, r.count_all)
+        self.assertEqual(6, r.sum_id)
+        self.assertEqual(3, r.max_id)
+        r = Student.aggregate(count='*', min='id', group_by='name')
+        self.assertEqual(['Chao', 'Ma'], [x.name for x in r])
+        self.assertEqual([2, 1], [x.count_all for x in r])
+        self.assertEqual([1, 3], [x.min_id for x in r])
+        r = Student.aggregate(count='*', group_by='name', having=('count_all > ?', 1))
+        self.assertEqual(1, len(r))
+        r = Student.aggregate(count='*', where={'name': 'Ma'})
+        self.assertEqual(1, r.count_all)
+        self.assertRaises(TypeError, lambda: Student.aggregate(median='id'))
+
+    def test_get_only(self):
+        insert('student', id=1, name='Chao', email='1@test.org')
+        r = Student.get_by_pk(1, only=['name'])
+        self.assertEqual(['id', 'name'], sorted(r.keys()))
+        self.assertEqual('1@test.org', r.email)
+        r = Student.get(name='Chao', defer=['email'])
+        self.assertNotIn('email', r[0])
+
+    def test_deferred_text_fields(self):
+        update('drop table if exists article')
+        Article.create_table()
+        for i in range(1, 4):
+            Article(id=i, title='t%d' % i, body='b%d' % i).insert()
+        r = Article.get_all()
+        self.assertNotIn('body', r[0])
+        self.assertEqual('b1', r[0].body)
+        # loaded for the whole result set at once
+        self.assertIn('body', r[2])
+        a = Article.get_by_pk(2)
+        a.title = 'new'
+        a.update_all()
+        self.assertEqual('b2', Article.get_by_pk(2, only=['body']).body)
+        update('drop table if exists article')
+
+    def test_values_list(self):
+        insert('student', id=1, name='Chao', email='1@test.org')
+        insert('student', id=2, name='Ma', email='2@test.org')
+        r = Student.values_list('id', 'name')
+        self.assertEqual([(1, 'Chao'), (2, 'Ma')], sorted(tuple(x) for x in r))
+        self.assertEqual([2], Student.values_list('id', flat=True, name='Ma'))
+        self.assertRaises(TypeError, lambda: Student.values_list('id', 'name', flat=True))
+
+    def test_changed_since(self):
+        self.assertIn('updated_at timestamp(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)',
+                      Ticket.create_table_sql())
+        self.assertIn('CREATE INDEX idx_updated_at_tid ON ticket (updated_at, tid);', Ticket.create_index_sql())
+        self.assertIn('deleted bool NOT NULL DEFAULT 0', Ticket.create_table_sql())
+        update('drop table if exists ticket')
+        Ticket.create_table()
+        for i in range(1, 4):
+            Ticket(tid=i, title='t%d' % i).insert()
+        # changes of the last lag seconds may not be committed yet
+        self.assertEqual([], list(Ticket.changed_since()))
+        changes = list(Ticket.changed_since(chunk_size=2, lag=0))
+        self.assertEqual([1, 2, 3], sorted(t.tid for t in changes))
+        self.assertEqual(3, len(list(Ticket.changed_since(time.time() - 3600, lag=0))))
+        cursor = changes[-1].change_cursor()
+        self.assertEqual([], list(Ticket.changed_since(cursor, lag=0)))
+        t = Ticket.get_by_pk(2)
+        t.title = 'new'
+        t.update_all()
+        self.assertEqual([2], [t.tid for t in Ticket.changed_since(cursor, lag=0)])
+        cursor = Ticket.get_by_pk(2).change_cursor()
+        Ticket.delete_by_pk(3)
+        self.assertEqual([(3, 1)], [(t.tid, t.deleted) for t in Ticket.changed_since(cursor, lag=0)])
+        self.assertEqual(None, Ticket.get_by_pk(3))
+        self.assertEqual(2, Ticket.count_all())
+        self.assertEqual([1, 2], sorted(Ticket.values_list('tid', flat=True)))
+        self.assertRaises(ModelError, lambda: list(Student.changed_since()))
+        update('drop table if exists ticket')
+
     def test_update_all(self):
         s = Student()
         u1 = dict(id=1, name='Chao', email='1@test.org')
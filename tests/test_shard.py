@@ -0,0 +1,126 @@
+import time
+from unittest import TestCase
+from ormini.db import *
+from ormini.models import *
+from ormini.fields import *
+from ormini.shard import *
+from config import configs
+
+
+class Member(Sharded, Model):
+    __shard_key__ = 'mid'
+    __shard_map__ = HashShardMap(['shard0', 'shard1'])
+    mid = IntegerField(primary_key=True)
+    name = CharField(max_length=20)
+    level = IntegerField()
+
+
+class Event(Sharded, Model):
+    __shard_key__ = 'eid'
+    __shard_map__ = HashShardMap(['shard0', 'shard1'])
+    eid = IntegerField(primary_key=True)
+    title = CharField(max_length=20)
+
+    class Meta:
+        track_changes = True
+
+
+class ShardTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        for name in ('shard0', 'shard1'):
+            if name not in shards:
+                add_shard(name, **configs[name])
+
+    def setUp(self):
+        scatter(['shard0', 'shard1'], update, 'drop table if exists member')
+        Member.create_table()
+        for i in range(10):
+            Member(mid=i, name='m%d' % (i % 3), level=i).insert()
+
+    def test_shard_map(self):
+        self.assertEqual(Member.__shard_map__.shard(7), Member.__shard_map__.shard(7))
+        r = RangeShardMap([(100, 'shard1'), (0, 'shard0')])
+        self.assertEqual('shard0', r.shard(99))
+        self.assertEqual('shard1', r.shard(100))
+        self.assertRaises(ShardError, lambda: r.shard(-1))
+
+    def test_insert_routes(self):
+        counts = scatter(['shard0', 'shard1'], select_int, 'select count(*) from member')
+        self.assertEqual(10, sum(counts))
+        for i in range(10):
+            with using_shard(Member.__shard_map__.shard(i)):
+                self.assertEqual(1, select_int('select count(*) from member where mid=?', i))
+
+    def test_get(self):
+        self.assertEqual('m1', Member.get_by_pk(7).name)
+        self.assertEqual(None, Member.get_by_pk(70))
+        self.assertEqual([0, 3, 6, 9], [m.mid for m in Member.get(name='m0')])
+        self.assertEqual(2, Member.get_first(name='m2').mid)
+        self.assertEqual(range(10), [m.mid for m in Member.get_all()])
+        self.assertEqual([0, 3, 6, 9], sorted(Member.values_list('mid', flat=True, name='m0')))
+
+    def test_count(self):
+        self.assertEqual(10, Member.count_all())
+        self.assertEqual(3, Member.count(name='m1'))
+        self.assertEqual(1, Member.count(mid=4))
+        self.assertEqual(5, Member.aggregate(max='level', where={'mid': 5}).max_level)
+        self.assertRaises(ShardError, lambda: Member.aggregate(max='level'))
+
+    def test_update_delete(self):
+        m = Member.get_by_pk(7)
+        m.level = 70
+        m.update_all()
+        self.assertEqual(70, Member.get_by_pk(7).level)
+        m.delete()
+        Member.delete_by_pk(4)
+        self.assertEqual(None, Member.get_by_pk(7))
+        self.assertEqual(8, Member.count_all())
+        self.assertEqual(4, Member.delete_by_attr(name='m0'))
+        self.assertEqual([1, 2, 5, 8], [m.mid for m in Member.get_all()])
+
+    def test_write_in_transaction(self):
+        def insert_in_transaction():
+            with TransactionContext():
+                Member(mid=20, name='m20', level=20).insert()
+
+        self.assertRaises(ShardError, insert_in_transaction)
+        self.assertRaises(ShardError, with_transaction(lambda: Member.delete_by_attr(name='m0')))
+        self.assertEqual(None, Member.get_by_pk(20))
+        self.assertEqual(10, Member.count_all())
+        # a transaction on the shard of the rows holds their writes
+        with using_shard(Member.__shard_map__.shard(20)):
+            try:
+                with TransactionContext():
+                    Member(mid=20, name='m20', level=20).insert()
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.assertEqual(None, Member.get_by_pk(20))
+            insert_in_transaction()
+        self.assertEqual('m20', Member.get_by_pk(20).name)
+
+    def test_scatter_deadline(self):
+        @with_connection(timeout=0.5)
+        def slow_count():
+            return scatter(['shard0', 'shard1'], select_int, 'select count(*) from member where sleep(?) = 0', 1)
+
+        start = time.time()
+        self.assertRaises(QueryTimeoutError, slow_count)
+        self.assertTrue(time.time() - start < 3)
+
+    def test_changed_since(self):
+        self.assertRaises(ShardError, lambda: Event.changed_since())
+        scatter(['shard0', 'shard1'], update, 'drop table if exists event')
+        Event.create_table()
+        for i in range(6):
+            Event(eid=i, title='e%d' % i).insert()
+        eids = []
+        for name in ('shard0', 'shard1'):
+            with using_shard(name):
+                expect = select_column('select eid from event order by eid')
+            changes = [e.eid for e in Event.changed_since(lag=0, shard=name)]
+            self.assertEqual(expect, sorted(changes))
+            eids.extend(changes)
+        self.assertEqual(range(6), sorted(eids))
+        scatter(['shard0', 'shard1'], update, 'drop table if exists event')
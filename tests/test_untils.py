@@ -22,3 +22,16 @@ class DictTests(TestCase):
         self.assertEqual(1, d.foo)
         self.assertEqual(2, d.bar)
         self.assertRaises(AttributeError, lambda: d.x)
+
+
+class NormalizeSqlTests(TestCase):
+    def test_placeholders(self):
+        self.assertEqual('select * from user where id=?', normalize_sql('select * from user where id=%s'))
+
+    def test_literals(self):
+        sql = "SELECT *  FROM user\n WHERE name='Chao' AND id=12"
+        self.assertEqual('select * from user where name=? and id=?', normalize_sql(sql))
+
+    def test_in_list(self):
+        self.assertEqual('select * from user where id in (?)',
+                         normalize_sql('select * from user where id in (?, ?, ?)'))